@@ -0,0 +1,41 @@
+# Tab icons for the LCD 128x64 GUI, shared by both scripts.
+#
+# Icons are 28x6 pixels. Each row is written as a 28 bit integer, most significant
+# bit on the left, and unpacked once at import time into the per-pixel values
+# expected by set_gui_tab_icon.
+
+ICON_WIDTH = 28
+
+
+def unpack_icon(*rows):
+    return bytes(
+        (row >> (ICON_WIDTH - 1 - x)) & 1 for row in rows for x in range(ICON_WIDTH)
+    )
+
+
+CONTROL_ICON = unpack_icon(
+    0b0000000100010001000100000000,
+    0b0000001110010001001110000000,
+    0b0000001110111001001110000000,
+    0b0000000100111011100100000000,
+    0b0000000100010011100100000000,
+    0b0000000100010001000100000000,
+)
+
+GRAPH_ICON = unpack_icon(
+    0b1000000000000000000000000000,
+    0b1000001110000000000000110000,
+    0b1000110001001000100111001000,
+    0b1011000000110111011000000111,
+    0b1000000000000000000000000000,
+    0b1111111111111111111111111111,
+)
+
+SETTINGS_ICON = unpack_icon(
+    0b0000000000000000000000000000,
+    0b0000000000000000000000000000,
+    0b0000000000010000010000000000,
+    0b0000000001000000000100000000,
+    0b0000000000111111111000000000,
+    0b0000000000000000000000000000,
+)
@@ -1,15 +1,17 @@
 #!/usr/bin/env python3
-import asyncio
 import atexit
 import json
 import socket
 
+from array import array
 from collections import deque
-from datetime import datetime, timedelta
+from datetime import datetime
 from logging import getLogger, INFO, StreamHandler, FileHandler
-from time import sleep
+from time import sleep, monotonic
 from subprocess import run
-from os import path
+from signal import signal, SIGINT, SIGTERM
+from threading import Event, Lock
+from os import stat
 
 from simple_pid import PID
 
@@ -19,11 +21,7 @@ from tinkerforge.bricklet_lcd_128x64 import BrickletLCD128x64
 from tinkerforge.bricklet_thermocouple_v2 import BrickletThermocoupleV2
 from tinkerforge.bricklet_solid_state_relay_v2 import BrickletSolidStateRelayV2
 
-
-def last_n_values(n, iterable):
-    for i in range(n, 0, -1):
-        yield iterable[-i]
-
+from _icons import CONTROL_ICON, GRAPH_ICON, SETTINGS_ICON
 
 LOGGER = getLogger(__name__)
 LOGGER.setLevel(INFO)
@@ -37,44 +35,48 @@ PID_TUNING_FILE_PATH = "tuning.json"
 HOST = "localhost"
 PORT = 4223
 
+# Delays in seconds between attempts to reach brickd. Doubles after each
+# failed attempt, up to the maximum.
+RETRY_DELAY = 0.05
+MAX_RETRY_DELAY = 1
+
 THERMOCOUPLE_READ_PERIOD = 1000
 GUI_READ_PERIOD = 100
 PWM_PERIOD = 1000
 N_SMOOTHING_POINTS = 5
 
-# If thermocouple is in error state for more than this long,
+MAX_SETPOINT = 1500
+
+# Setpoint change for each of the control tab buttons, by button index
+SETPOINT_BUTTON_DELTAS = (-1, 1, -10, 10, -100, 100)
+
+# Position, size and label of each of the control tab buttons, by button index
+SETPOINT_BUTTON_LAYOUTS = (
+    (2, 18, 61, 11, "-1\xDFC"),
+    (66, 18, 61, 11, "+1\xDFC"),
+    (2, 30, 61, 11, "-10\xDFC"),
+    (66, 30, 61, 11, "+10\xDFC"),
+    (2, 42, 61, 11, "-100\xDFC"),
+    (66, 42, 61, 11, "+100\xDFC"),
+)
+
+# If thermocouple is in error state for more than this many seconds,
 # deactivate output until it comes back online.
-DEACTIVATE_POWER_DELAY = timedelta(seconds=11)
-
-
-# fmt: off
-CONTROL_ICON = [
-    0,0,0,0,0,0,0,1,0,0,0,1,0,0,0,1,0,0,0,1,0,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,1,1,1,0,0,1,0,0,0,1,0,0,1,1,1,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,1,1,1,0,1,1,1,0,0,1,0,0,1,1,1,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,0,1,0,0,1,1,1,0,1,1,1,0,0,1,0,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,0,1,0,0,0,1,0,0,1,1,1,0,0,1,0,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,0,1,0,0,0,1,0,0,0,1,0,0,0,1,0,0,0,0,0,0,0,0,
-]
-
-GRAPH_ICON = [
-    1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,
-    1,0,0,0,0,0,1,1,1,0,0,0,0,0,0,0,0,0,0,0,0,0,1,1,0,0,0,0,
-    1,0,0,0,1,1,0,0,0,1,0,0,1,0,0,0,1,0,0,1,1,1,0,0,1,0,0,0,
-    1,0,1,1,0,0,0,0,0,0,1,1,0,1,1,1,0,1,1,0,0,0,0,0,0,1,1,1,
-    1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,
-    1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,
-]
-
-SETTINGS_ICON = [
-    0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,0,0,0,0,0,1,0,0,0,0,0,1,0,0,0,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,0,0,0,1,0,0,0,0,0,0,0,0,0,1,0,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,0,0,0,0,1,1,1,1,1,1,1,1,1,0,0,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,
-]
-# fmt: on
+DEACTIVATE_POWER_DELAY = 11
+
+
+def retry_with_backoff(operation, name):
+    delay = RETRY_DELAY
+    while True:
+        try:
+            operation()
+            return
+        except TFConnectionError as error:
+            LOGGER.error("%s Error: %s", name, error.description)
+        except socket.error as error:
+            LOGGER.error("Socket Error: %s", error)
+        sleep(delay)
+        delay = min(delay * 2, MAX_RETRY_DELAY)
 
 
 class Heater:
@@ -93,6 +95,10 @@ class Heater:
     # PWM power for output. 0 - 100
     heater_power = 0
 
+    # PWM on and off times in ms for the current heater power
+    pwm_on_time = 0
+    pwm_off_time = PWM_PERIOD
+
     # Current state of output. Boolean
     heater_active = False
 
@@ -100,15 +106,28 @@ class Heater:
     thermocouple_in_error_state = False
     error_state_start = None
 
+    # Set once the heater has been shut down
+    closed = False
+
     # Current active GUI tab index
     active_tab = 0
 
+    # The last strings (and graph data) drawn for each field on the display, so
+    # that unchanged fields aren't sent to the LCD again. Reset to None whenever
+    # the display is cleared, in which case there's no old text to box out
+    # before drawing a field.
+    _last_temp_string = None
+    _last_power_string = None
+    _last_setpoint_string = None
+    _last_axis_strings = None
+    _last_graph_data = None
+
     # Number of readings to keep in state. This is set to match graph width
     n_temp_points = 107
 
     starting_temp = 20
     initial_temp_data = [starting_temp] * N_SMOOTHING_POINTS
-    temp_data = deque(initial_temp_data, n_temp_points)
+    temp_data = None
 
     # Min and max for graph Y axis. Updated automatically with data
     axis_min = starting_temp - 10
@@ -123,22 +142,37 @@ class Heater:
     # Current target tunings
     tunings = {"p": 0, "i": 0, "d": 0, "bias": 0, "proportional_on_measurement": False}
 
+    # Modification time of the tunings file when it was last read
+    _tunings_mtime = None
+
+    # Tunings last applied to the PID
+    _applied_tunings = None
+
     def __init__(self):
         LOGGER.info("Heater starting...")
 
+        # Guards relay commands against close() on another thread
+        self._relay_lock = Lock()
+
+        self._init_temp_data()
         self._init_pid()
 
+        # Display updates to make for each new reading, indexed by active tab
+        self._tab_updaters = (
+            (self.write_temp, self.write_power),
+            (self.update_graph,),
+            (),
+        )
+
+        # Set-up to run for each enumerated bricklet, by device identifier
+        self._device_initialisers = {
+            BrickletLCD128x64.DEVICE_IDENTIFIER: self._init_lcd,
+            BrickletThermocoupleV2.DEVICE_IDENTIFIER: self._init_thermocouple,
+            BrickletSolidStateRelayV2.DEVICE_IDENTIFIER: self._init_relay,
+        }
+
         self.ipcon = IPConnection()
-        while True:
-            try:
-                self.ipcon.connect(HOST, PORT)
-                break
-            except TFConnectionError as error:
-                LOGGER.error("Connection Error: " + str(error.description))
-                sleep(1)
-            except socket.error as error:
-                LOGGER.error("Socket Error: " + str(error))
-                sleep(1)
+        retry_with_backoff(lambda: self.ipcon.connect(HOST, PORT), "Connection")
 
         self.ipcon.register_callback(IPConnection.CALLBACK_ENUMERATE, self.cb_enumerate)
         self.ipcon.register_callback(IPConnection.CALLBACK_CONNECTED, self.cb_connected)
@@ -153,45 +187,129 @@ class Heater:
                 f"Timestamp, Temp (°C), Setpoint (°C), Power (%), Kp, Ki, Kd, Cp, Ci, Cd"
             )
 
-        while True:
-            try:
-                self.ipcon.enumerate()
-                return
-            except TFConnectionError as error:
-                LOGGER.error("Enumerate Error: " + str(error.description))
-                sleep(1)
+        self._enumerate()
+
+    def _enumerate(self):
+        # This can only fail if the connection has just dropped. There's no need to
+        # retry: the IP connection reconnects automatically and cb_connected will
+        # enumerate again once it has.
+        try:
+            self.ipcon.enumerate()
+        except TFConnectionError as error:
+            LOGGER.error("Enumerate Error: %s", error.description)
+
+    def _init_temp_data(self):
+        # Ring buffer of the most recent readings. Stored as a flat array of
+        # doubles rather than a deque of float objects.
+        self.temp_data = array("d", [0]) * self.n_temp_points
+        self._temp_data_head = 0
+
+        # Reused for the scaled values sent to the LCD graph. Any points we don't
+        # have readings for yet are left as 0, which the graph shows the same as
+        # points we haven't sent.
+        self._graph_data = bytearray(self.n_temp_points)
+
+        # Candidate (reading number, value) pairs for the min and max of temp_data.
+        # These are kept monotonic so the current min and max are always at the
+        # front, which saves scanning the whole of temp_data on every update.
+        self._min_temps = deque()
+        self._max_temps = deque()
+        self._n_readings = 0
+
+        for value in self.initial_temp_data:
+            self._append_temp(value)
+
+        # Most recent readings, the median of which is used as the PID input.
+        # A median rejects the single-reading spikes we sometimes get when the
+        # thermocouple bricklet is physically bumped.
+        self._smooth_window = deque(self.initial_temp_data, N_SMOOTHING_POINTS)
+
+    def _append_temp(self, value):
+        reading = self._n_readings
+        self._n_readings += 1
+        self.temp_data[self._temp_data_head] = value
+        self._temp_data_head = (self._temp_data_head + 1) % self.n_temp_points
+
+        while self._min_temps and self._min_temps[-1][1] >= value:
+            self._min_temps.pop()
+        self._min_temps.append((reading, value))
+
+        while self._max_temps and self._max_temps[-1][1] <= value:
+            self._max_temps.pop()
+        self._max_temps.append((reading, value))
+
+        # Drop any candidate which has just fallen out of temp_data
+        oldest = reading - self.n_temp_points
+        if self._min_temps[0][0] <= oldest:
+            self._min_temps.popleft()
+        if self._max_temps[0][0] <= oldest:
+            self._max_temps.popleft()
+
+    def _latest_temp(self):
+        return self.temp_data[self._temp_data_head - 1]
+
+    def _temps_oldest_first(self):
+        if self._n_readings < self.n_temp_points:
+            return self.temp_data[: self._n_readings]
+        head = self._temp_data_head
+        return self.temp_data[head:] + self.temp_data[:head]
 
     def _init_pid(self):
         self.pid = PID(setpoint=self.setpoint, output_limits=(0, 100))
         self._read_pid_tunings_from_file()
         self._set_pid_tuning(self.tunings)
 
+    # Returns True if the tunings were (re)loaded from the file
     def _read_pid_tunings_from_file(self):
-        if not path.exists(PID_TUNING_FILE_PATH):
+        try:
+            mtime = stat(PID_TUNING_FILE_PATH).st_mtime_ns
+        except FileNotFoundError:
             LOGGER.info(
                 f"{PID_TUNING_FILE_PATH} does not exist. Using default tunings."
             )
-            return
+            return False
 
-        with open(PID_TUNING_FILE_PATH, "r") as f:
+        # Skip parsing the file again if it hasn't changed since we last read it
+        if mtime == self._tunings_mtime:
+            return False
+
+        with open(PID_TUNING_FILE_PATH, "rb") as f:
             self.tunings = json.load(f)
+        self._tunings_mtime = mtime
+        return True
 
     def _set_pid_tuning(self, tuning_dict):
+        # The file may have been saved again without its contents changing
+        if tuning_dict == self._applied_tunings:
+            return
+
         tunings = (tuning_dict.get(parameter, 0) for parameter in ("p", "i", "d"))
         self.pid.tunings = tunings
         self.pid.proportional_on_measurement = tuning_dict.get(
             "proportional_on_measurement", False
         )
         self.pid.bias = tuning_dict.get("bias", 0)
+        self._applied_tunings = dict(tuning_dict)
 
     def _init_lcd(self, uid):
         try:
             self.lcd = BrickletLCD128x64(uid, self.ipcon)
+            # Drawing calls are already sent without waiting for a response. Do the
+            # same for the GUI callback configuration so that none of the setup
+            # calls wait on a round trip to the bricklet.
+            self.lcd.set_response_expected(
+                BrickletLCD128x64.FUNCTION_SET_GUI_TAB_SELECTED_CALLBACK_CONFIGURATION,
+                False,
+            )
+            self.lcd.set_response_expected(
+                BrickletLCD128x64.FUNCTION_SET_GUI_BUTTON_PRESSED_CALLBACK_CONFIGURATION,
+                False,
+            )
             self.lcd.clear_display()
             self.lcd.remove_all_gui()
             LOGGER.info("LCD128x64 initialized")
         except TFConnectionError as error:
-            LOGGER.error("LCD128x64 init failed: " + str(error.description))
+            LOGGER.error("LCD128x64 init failed: %s", error.description)
             return
 
         self.lcd.set_gui_tab_selected_callback_configuration(GUI_READ_PERIOD, True)
@@ -214,16 +332,13 @@ class Heater:
     def cb_tab(self, index):
         self.active_tab = index
         self.lcd.clear_display()
+        self._reset_last_drawn()
         if index == 0:
             self.write_temp()
             self.write_setpoint()
             self.write_power()
-            self.lcd.set_gui_button(0, 2, 18, 61, 11, "-1\xDFC")
-            self.lcd.set_gui_button(1, 66, 18, 61, 11, "+1\xDFC")
-            self.lcd.set_gui_button(2, 2, 30, 61, 11, "-10\xDFC")
-            self.lcd.set_gui_button(3, 66, 30, 61, 11, "+10\xDFC")
-            self.lcd.set_gui_button(4, 2, 42, 61, 11, "-100\xDFC")
-            self.lcd.set_gui_button(5, 66, 42, 61, 11, "+100\xDFC")
+            for button_index, layout in enumerate(SETPOINT_BUTTON_LAYOUTS):
+                self.lcd.set_gui_button(button_index, *layout)
 
         elif index == 1:
             self.lcd.set_gui_graph_configuration(
@@ -238,6 +353,9 @@ class Heater:
             self.lcd.set_gui_button(6, 0, 10, 80, 20, "Shut Down")
 
     def _cb_set_button(self, setpoint):
+        # Nothing to do when pressed while already clamped at 0 or the maximum
+        if setpoint == self.setpoint:
+            return
         self.setpoint = setpoint
         self.pid.setpoint = setpoint
         self.write_setpoint()
@@ -245,18 +363,9 @@ class Heater:
     def cb_button(self, index, value):
         if value is False:
             return
-        if index == 0:
-            self._cb_set_button(max(self.setpoint - 1, 0))
-        elif index == 1:
-            self._cb_set_button(min(self.setpoint + 1, 1500))
-        elif index == 2:
-            self._cb_set_button(max(self.setpoint - 10, 0))
-        elif index == 3:
-            self._cb_set_button(min(self.setpoint + 10, 1500))
-        elif index == 4:
-            self._cb_set_button(max(self.setpoint - 100, 0))
-        elif index == 5:
-            self._cb_set_button(min(self.setpoint + 100, 1500))
+        if index < len(SETPOINT_BUTTON_DELTAS):
+            setpoint = self.setpoint + SETPOINT_BUTTON_DELTAS[index]
+            self._cb_set_button(max(min(setpoint, MAX_SETPOINT), 0))
         elif index == 6:
             self.close()
             self.shutdown_host()
@@ -264,9 +373,15 @@ class Heater:
     def _init_thermocouple(self, uid):
         try:
             self.thermocouple = BrickletThermocoupleV2(uid, self.ipcon)
+            # As for the LCD, don't wait on a round trip for the callback
+            # configuration.
+            self.thermocouple.set_response_expected(
+                BrickletThermocoupleV2.FUNCTION_SET_TEMPERATURE_CALLBACK_CONFIGURATION,
+                False,
+            )
             LOGGER.info("Thermocouple initialized")
         except TFConnectionError as error:
-            LOGGER.error("Thermocouple init failed: " + str(error.description))
+            LOGGER.error("Thermocouple init failed: %s", error.description)
             return
 
         self.thermocouple.set_configuration(
@@ -289,7 +404,7 @@ class Heater:
 
     def cb_thermocouple_error(self, over_under, open_circuit):
         if any((over_under, open_circuit)):
-            self.error_state_start = datetime.now()
+            self.error_state_start = monotonic()
         else:
             self.error_state_start = None
 
@@ -299,20 +414,19 @@ class Heater:
         )
 
     def get_pid_value(self):
-        current_temp = (
-            sum(last_n_values(N_SMOOTHING_POINTS, self.temp_data)) / N_SMOOTHING_POINTS
-        )
+        current_temp = sorted(self._smooth_window)[N_SMOOTHING_POINTS // 2]
 
-        if self.tuning_mode:
-            self._read_pid_tunings_from_file()
+        if self.tuning_mode and self._read_pid_tunings_from_file():
             self._set_pid_tuning(self.tunings)
 
-        return self.pid(current_temp)
+        # Readings arrive at a fixed period, so use that rather than the time
+        # between callbacks, which includes any delivery jitter.
+        return self.pid(current_temp, dt=THERMOCOUPLE_READ_PERIOD / 1000)
 
     def cb_thermocouple_reading(self, value):
         if (
-            self.error_state_start
-            and (datetime.now() - self.error_state_start) > DEACTIVATE_POWER_DELAY
+            self.error_state_start is not None
+            and (monotonic() - self.error_state_start) > DEACTIVATE_POWER_DELAY
         ):
             self.thermocouple_in_error_state = True
         else:
@@ -320,55 +434,56 @@ class Heater:
 
         if self.thermocouple_in_error_state:
             power = 0
+            self.pid.auto_mode = False
             LOGGER.info("Thermocouple in error state. Output deactivated.")
         else:
+            if not self.pid.auto_mode:
+                # Restart from zero output rather than from the integral and
+                # last input left over from before the error
+                self.pid.set_auto_mode(True, last_output=0)
             current_temp = value / 100
-            self.temp_data.append(current_temp)
+            self._smooth_window.append(current_temp)
+            self._append_temp(current_temp)
             power = self.get_pid_value()
 
         old_power = self.heater_power
         sticky_state_active = old_power == 100 or old_power == 0
         self.heater_power = power
+        self.pwm_on_time = round(power * PWM_PERIOD / 100)
+        self.pwm_off_time = PWM_PERIOD - self.pwm_on_time
+
+        with self._relay_lock:
+            # Once closed, the relay must stay off
+            if self.closed:
+                return
+            if power == 100:
+                self.relay.set_state(True)
+                self.heater_active = True
+            elif power == 0:
+                self.relay.set_state(False)
+                self.heater_active = False
+            elif 0 < power < 100 and sticky_state_active:
+                # If we're coming out of a sticky state, kick off the
+                # flop loop for PWM.
+                self.relay.set_state(False)
+                self.heater_active = False
+                self.relay.set_monoflop(False, 0)
 
-        if power == 100:
-            self.relay.set_state(True)
-            self.heater_active = True
-        elif power == 0:
-            self.relay.set_state(False)
-            self.heater_active = False
-        elif 0 < power < 100 and sticky_state_active:
-            # If we're coming out of a sticky state, kick off the
-            # flop loop for PWM.
-            self.relay.set_state(False)
-            self.heater_active = False
-            self.relay.set_monoflop(False, 0)
-
-        self.write_temp()
-        self.write_power()
-        self.update_graph()
+        if self.lcd is not None:
+            for update in self._tab_updaters[self.active_tab]:
+                update()
 
         if self.logging_mode:
             self.log_line()
 
     def log_line(self):
         timestamp = datetime.now().strftime(DATETIME_FMT)
-        current_temp = self.temp_data[-1]
+        current_temp = self._latest_temp()
         kp, ki, kd = self.pid.tunings
         cp, ci, cd = self.pid.components
-        log_line = ", ".join(
-            str(value)
-            for value in (
-                timestamp,
-                current_temp,
-                self.setpoint,
-                self.heater_power,
-                kp,
-                ki,
-                kd,
-                cp,
-                ci,
-                cd,
-            )
+        log_line = (
+            f"{timestamp}, {current_temp}, {self.setpoint}, {self.heater_power}, "
+            f"{kp}, {ki}, {kd}, {cp}, {ci}, {cd}"
         )
         self.data_logger.info(log_line)
 
@@ -377,48 +492,61 @@ class Heater:
             self.relay = BrickletSolidStateRelayV2(uid, self.ipcon)
             LOGGER.info("Relay initialized")
         except TFConnectionError as error:
-            LOGGER.error("Relay init failed: " + str(error.description))
+            LOGGER.error("Relay init failed: %s", error.description)
             return
 
+        # Bound once as this is called on every PWM edge
+        self._set_monoflop = self.relay.set_monoflop
         self.relay.register_callback(
             BrickletSolidStateRelayV2.CALLBACK_MONOFLOP_DONE, self.cb_relay_flop
         )
         self.relay.set_state(False)
 
     def cb_relay_flop(self, _):
-        on_time = round((self.heater_power / 100) * PWM_PERIOD)
-        off_time = PWM_PERIOD - on_time
-
-        if self.heater_power < 100:
-            if self.heater_active:
-                self.relay.set_monoflop(False, off_time)
-                self.heater_active = False
-            else:
-                self.relay.set_monoflop(True, on_time)
-                self.heater_active = True
-        # If power is 0 or 100, we're not using the flop loop
+        with self._relay_lock:
+            if self.closed:
+                return
+            if 0 < self.heater_power < 100:
+                if self.heater_active:
+                    self._set_monoflop(False, self.pwm_off_time)
+                    self.heater_active = False
+                else:
+                    self._set_monoflop(True, self.pwm_on_time)
+                    self.heater_active = True
+            # If power is 0 or 100, we're not using the flop loop
+
+    def _reset_last_drawn(self):
+        self._last_temp_string = None
+        self._last_power_string = None
+        self._last_setpoint_string = None
+        self._last_axis_strings = None
+        self._last_graph_data = None
 
     def write_temp(self):
         if self.lcd is None:
             return
-        if self.active_tab != 0:
-            return
-        current_temp = self.temp_data[-1]
+        current_temp = self._latest_temp()
         temp_string = (
             f"T: {current_temp:2.0f}\xDFC"
             if not self.thermocouple_in_error_state
             else "T: ERR!"
         )
-        self.lcd.draw_box(0, 0, 59, 10, True, BrickletLCD128x64.COLOR_WHITE)
+        if temp_string == self._last_temp_string:
+            return
+        if self._last_temp_string is not None:
+            self.lcd.draw_box(0, 0, 59, 10, True, BrickletLCD128x64.COLOR_WHITE)
+        self._last_temp_string = temp_string
         self.lcd.draw_text(0, 0, BrickletLCD128x64.FONT_6X8, True, temp_string)
 
     def write_power(self):
         if self.lcd is None:
             return
-        if self.active_tab != 0:
-            return
-        self.lcd.draw_box(0, 10, 127, 19, True, BrickletLCD128x64.COLOR_WHITE)
         string = f"Power: {self.heater_power:3.1f}%"
+        if string == self._last_power_string:
+            return
+        if self._last_power_string is not None:
+            self.lcd.draw_box(0, 10, 127, 19, True, BrickletLCD128x64.COLOR_WHITE)
+        self._last_power_string = string
         self.lcd.draw_text(0, 10, BrickletLCD128x64.FONT_6X8, True, string)
 
     def write_setpoint(self):
@@ -428,28 +556,31 @@ class Heater:
             return
 
         set_string = f"S: {self.setpoint}\xDFC"
-        self.lcd.draw_box(60, 0, 127, 10, True, BrickletLCD128x64.COLOR_WHITE)
+        if set_string == self._last_setpoint_string:
+            return
+        if self._last_setpoint_string is not None:
+            self.lcd.draw_box(60, 0, 127, 10, True, BrickletLCD128x64.COLOR_WHITE)
+        self._last_setpoint_string = set_string
         self.lcd.draw_text(60, 0, BrickletLCD128x64.FONT_6X8, True, set_string)
 
     def update_axis(self):
-        self.lcd.draw_box(0, 0, 20, 10, True, BrickletLCD128x64.COLOR_WHITE)
-        self.lcd.draw_box(0, 45, 20, 55, True, BrickletLCD128x64.COLOR_WHITE)
-        self.lcd.draw_text(
-            0, 0, BrickletLCD128x64.FONT_6X8, True, f"{self.axis_max:3.0f}"
-        )
-        self.lcd.draw_text(
-            0, 45, BrickletLCD128x64.FONT_6X8, True, f"{self.axis_min:3.0f}"
-        )
-        self.lcd.draw_text(0, 107, BrickletLCD128x64.FONT_6X8, True, f"")
+        max_string = f"{self.axis_max:3.0f}"
+        min_string = f"{self.axis_min:3.0f}"
+        if (max_string, min_string) == self._last_axis_strings:
+            return
+        if self._last_axis_strings is not None:
+            self.lcd.draw_box(0, 0, 20, 10, True, BrickletLCD128x64.COLOR_WHITE)
+            self.lcd.draw_box(0, 45, 20, 55, True, BrickletLCD128x64.COLOR_WHITE)
+        self._last_axis_strings = (max_string, min_string)
+        self.lcd.draw_text(0, 0, BrickletLCD128x64.FONT_6X8, True, max_string)
+        self.lcd.draw_text(0, 45, BrickletLCD128x64.FONT_6X8, True, min_string)
 
     def update_graph(self):
         if self.lcd is None:
             return
-        if self.active_tab != 1:
-            return
 
-        max_temp = max(self.temp_data)
-        min_temp = min(self.temp_data)
+        max_temp = self._max_temps[0][1]
+        min_temp = self._min_temps[0][1]
 
         # Pad a little bit for looks
         max_temp *= 1.1
@@ -460,63 +591,70 @@ class Heater:
             # This probably means we don't have any data yet
             return
 
-        scaled_data = [((value - min_temp) / diff) * 255 for value in self.temp_data]
-
-        # This gets rid of any randomness which apparently sometimes occurs when
-        # the thermocouple bricklet is physically bumped.
-        scaled_data = map(lambda value: max(min(value, 255), 0), scaled_data)
+        # Scale and clamp in a single pass. The clamp gets rid of any randomness
+        # which apparently sometimes occurs when the thermocouple bricklet is
+        # physically bumped.
+        scale = 255 / diff
+        graph_data = self._graph_data
+        for i, value in enumerate(self._temps_oldest_first()):
+            scaled = int((value - min_temp) * scale)
+            graph_data[i] = 0 if scaled < 0 else 255 if scaled > 255 else scaled
 
         if max_temp != self.axis_max or min_temp != self.axis_min:
             self.axis_max = max_temp
             self.axis_min = min_temp
             self.update_axis()
 
-        self.lcd.set_gui_graph_data(0, scaled_data)
+        # Steady readings often scale to exactly the same graph
+        if graph_data == self._last_graph_data:
+            return
+        self._last_graph_data = bytes(graph_data)
+        self.lcd.set_gui_graph_data(0, graph_data)
 
     def cb_enumerate(self, uid, _, __, ___, ____, device_identifier, enumeration_type):
         if (
             enumeration_type == IPConnection.ENUMERATION_TYPE_CONNECTED
             or enumeration_type == IPConnection.ENUMERATION_TYPE_AVAILABLE
         ):
-            if device_identifier == BrickletLCD128x64.DEVICE_IDENTIFIER:
-                self._init_lcd(uid)
-            elif device_identifier == BrickletThermocoupleV2.DEVICE_IDENTIFIER:
-                self._init_thermocouple(uid)
-            elif device_identifier == BrickletSolidStateRelayV2.DEVICE_IDENTIFIER:
-                self._init_relay(uid)
+            init_device = self._device_initialisers.get(device_identifier)
+            if init_device is not None:
+                init_device(uid)
 
     def cb_connected(self, connected_reason):
         if connected_reason == IPConnection.CONNECT_REASON_AUTO_RECONNECT:
             LOGGER.info("Auto Reconnect")
-
-            while True:
-                try:
-                    self.ipcon.enumerate()
-                    break
-                except TFConnectionError as error:
-                    LOGGER.error("Enumerate Error: " + str(error.description))
-                    sleep(1)
+            self._enumerate()
 
     def close(self):
+        # close() can run on the main thread while callbacks are still being
+        # delivered, so switch the relay off under the lock to stop a callback
+        # turning it back on before we disconnect.
+        with self._relay_lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.relay:
+                self.relay.set_state(False)
+
         if self.lcd:
             self.lcd.clear_display()
             self.lcd.remove_all_gui()
-        if self.relay:
-            self.relay.set_state(False)
         if self.ipcon is not None:
             self.ipcon.disconnect()
         LOGGER.info("Heater shut down")
 
     def shutdown_host(self):
-        run("sudo shutdown now", shell=True)
+        run(["sudo", "shutdown", "now"])
 
 
 if __name__ == "__main__":
     heater = Heater()
     atexit.register(heater.close)
 
-    loop = asyncio.get_event_loop()
-    try:
-        loop.run_forever()
-    finally:
-        loop.close()
+    # All the work happens in Tinkerforge callbacks, so the main thread just
+    # sleeps until we're asked to stop. Exiting normally ensures the atexit
+    # cleanup runs.
+    stop = Event()
+    for signal_number in (SIGINT, SIGTERM):
+        signal(signal_number, lambda *_: stop.set())
+    stop.wait()
@@ -1,12 +1,14 @@
 #!/usr/bin/env python3
-import asyncio
 import atexit
 import socket
 
+from array import array
 from collections import deque
 from logging import getLogger, INFO, StreamHandler
 from time import sleep
 from subprocess import run
+from signal import signal, SIGINT, SIGTERM
+from threading import Event, Lock
 
 from tinkerforge.ip_connection import IPConnection
 from tinkerforge.ip_connection import Error as TFConnectionError
@@ -14,6 +16,8 @@ from tinkerforge.bricklet_lcd_128x64 import BrickletLCD128x64
 from tinkerforge.bricklet_thermocouple_v2 import BrickletThermocoupleV2
 from tinkerforge.bricklet_solid_state_relay_v2 import BrickletSolidStateRelayV2
 
+from _icons import CONTROL_ICON, GRAPH_ICON, SETTINGS_ICON
+
 LOGGER = getLogger(__name__)
 LOGGER.setLevel(INFO)
 LOGGER.addHandler(StreamHandler())
@@ -21,38 +25,39 @@ LOGGER.addHandler(StreamHandler())
 HOST = "localhost"
 PORT = 4223
 
+# Delays in seconds between attempts to reach brickd. Doubles after each
+# failed attempt, up to the maximum.
+RETRY_DELAY = 0.05
+MAX_RETRY_DELAY = 1
+
 THERMOCOUPLE_READ_PERIOD = 1000
 GUI_READ_PERIOD = 100
 PWM_PERIOD = 1000
 
-# fmt: off
-CONTROL_ICON = [
-    0,0,0,0,0,0,0,1,0,0,0,1,0,0,0,1,0,0,0,1,0,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,1,1,1,0,0,1,0,0,0,1,0,0,1,1,1,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,1,1,1,0,1,1,1,0,0,1,0,0,1,1,1,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,0,1,0,0,1,1,1,0,1,1,1,0,0,1,0,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,0,1,0,0,0,1,0,0,1,1,1,0,0,1,0,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,0,1,0,0,0,1,0,0,0,1,0,0,0,1,0,0,0,0,0,0,0,0,
-]
-
-GRAPH_ICON = [
-    1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,
-    1,0,0,0,0,0,1,1,1,0,0,0,0,0,0,0,0,0,0,0,0,0,1,1,0,0,0,0,
-    1,0,0,0,1,1,0,0,0,1,0,0,1,0,0,0,1,0,0,1,1,1,0,0,1,0,0,0,
-    1,0,1,1,0,0,0,0,0,0,1,1,0,1,1,1,0,1,1,0,0,0,0,0,0,1,1,1,
-    1,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,
-    1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,1,
-]
-
-SETTINGS_ICON = [
-    0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,0,0,0,0,0,1,0,0,0,0,0,1,0,0,0,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,0,0,0,1,0,0,0,0,0,0,0,0,0,1,0,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,0,0,0,0,1,1,1,1,1,1,1,1,1,0,0,0,0,0,0,0,0,0,
-    0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,0,
-]
-# fmt: on
+# Power change for each of the control tab buttons, by button index
+POWER_BUTTON_DELTAS = (-1, 1, -10, 10)
+
+# Position, size and label of each of the control tab buttons, by button index
+POWER_BUTTON_LAYOUTS = (
+    (2, 22, 61, 14, "-1%"),
+    (66, 22, 61, 14, "+1%"),
+    (2, 38, 61, 14, "-10%"),
+    (66, 38, 61, 14, "+10%"),
+)
+
+
+def retry_with_backoff(operation, name):
+    delay = RETRY_DELAY
+    while True:
+        try:
+            operation()
+            return
+        except TFConnectionError as error:
+            LOGGER.error("%s Error: %s", name, error.description)
+        except socket.error as error:
+            LOGGER.error("Socket Error: %s", error)
+        sleep(delay)
+        delay = min(delay * 2, MAX_RETRY_DELAY)
 
 
 class Heater:
@@ -67,51 +72,140 @@ class Heater:
     # PWM power for output. 0 - 100
     heater_power = 0
 
+    # PWM on and off times in ms for the current heater power
+    pwm_on_time = 0
+    pwm_off_time = PWM_PERIOD
+
     # Current state of output. Boolean
     heater_active = False
 
+    # Set once the heater has been shut down
+    closed = False
+
     # Current active GUI tab index
     active_tab = 0
 
+    # The last strings (and graph data) drawn for each field on the display, so
+    # that unchanged fields aren't sent to the LCD again. Reset to None whenever
+    # the display is cleared, in which case there's no old text to box out
+    # before drawing a field.
+    _last_temp_string = None
+    _last_power_string = None
+    _last_axis_strings = None
+    _last_graph_data = None
+
     # This is set to match graph width
     n_temp_points = 107
-    temp_data = deque([0], n_temp_points)
+    initial_temp_data = [0]
+    temp_data = None
     axis_min = 0
     axis_max = 0
 
     def __init__(self):
         LOGGER.info("Heater starting...")
+
+        # Guards relay commands against close() on another thread
+        self._relay_lock = Lock()
+
+        self._init_temp_data()
+
+        # Display updates to make for each new reading, indexed by active tab
+        self._tab_updaters = ((self.write_temp,), (self.update_graph,), ())
+
+        # Set-up to run for each enumerated bricklet, by device identifier
+        self._device_initialisers = {
+            BrickletLCD128x64.DEVICE_IDENTIFIER: self._init_lcd,
+            BrickletThermocoupleV2.DEVICE_IDENTIFIER: self._init_thermocouple,
+            BrickletSolidStateRelayV2.DEVICE_IDENTIFIER: self._init_relay,
+        }
+
         self.ipcon = IPConnection()
-        while True:
-            try:
-                self.ipcon.connect(HOST, PORT)
-                break
-            except TFConnectionError as error:
-                LOGGER.error("Connection Error: " + str(error.description))
-                sleep(1)
-            except socket.error as error:
-                LOGGER.error("Socket Error: " + str(error))
-                sleep(1)
+        retry_with_backoff(lambda: self.ipcon.connect(HOST, PORT), "Connection")
 
         self.ipcon.register_callback(IPConnection.CALLBACK_ENUMERATE, self.cb_enumerate)
         self.ipcon.register_callback(IPConnection.CALLBACK_CONNECTED, self.cb_connected)
 
-        while True:
-            try:
-                self.ipcon.enumerate()
-                return
-            except TFConnectionError as error:
-                LOGGER.error("Enumerate Error: " + str(error.description))
-                sleep(1)
+        self._enumerate()
+
+    def _enumerate(self):
+        # This can only fail if the connection has just dropped. There's no need to
+        # retry: the IP connection reconnects automatically and cb_connected will
+        # enumerate again once it has.
+        try:
+            self.ipcon.enumerate()
+        except TFConnectionError as error:
+            LOGGER.error("Enumerate Error: %s", error.description)
+
+    def _init_temp_data(self):
+        # Ring buffer of the most recent readings. Stored as a flat array of
+        # doubles rather than a deque of float objects.
+        self.temp_data = array("d", [0]) * self.n_temp_points
+        self._temp_data_head = 0
+
+        # Reused for the scaled values sent to the LCD graph. Any points we don't
+        # have readings for yet are left as 0, which the graph shows the same as
+        # points we haven't sent.
+        self._graph_data = bytearray(self.n_temp_points)
+
+        # Candidate (reading number, value) pairs for the min and max of temp_data.
+        # These are kept monotonic so the current min and max are always at the
+        # front, which saves scanning the whole of temp_data on every update.
+        self._min_temps = deque()
+        self._max_temps = deque()
+        self._n_readings = 0
+
+        for value in self.initial_temp_data:
+            self._append_temp(value)
+
+    def _append_temp(self, value):
+        reading = self._n_readings
+        self._n_readings += 1
+        self.temp_data[self._temp_data_head] = value
+        self._temp_data_head = (self._temp_data_head + 1) % self.n_temp_points
+
+        while self._min_temps and self._min_temps[-1][1] >= value:
+            self._min_temps.pop()
+        self._min_temps.append((reading, value))
+
+        while self._max_temps and self._max_temps[-1][1] <= value:
+            self._max_temps.pop()
+        self._max_temps.append((reading, value))
+
+        # Drop any candidate which has just fallen out of temp_data
+        oldest = reading - self.n_temp_points
+        if self._min_temps[0][0] <= oldest:
+            self._min_temps.popleft()
+        if self._max_temps[0][0] <= oldest:
+            self._max_temps.popleft()
+
+    def _latest_temp(self):
+        return self.temp_data[self._temp_data_head - 1]
+
+    def _temps_oldest_first(self):
+        if self._n_readings < self.n_temp_points:
+            return self.temp_data[: self._n_readings]
+        head = self._temp_data_head
+        return self.temp_data[head:] + self.temp_data[:head]
 
     def _init_lcd(self, uid):
         try:
             self.lcd = BrickletLCD128x64(uid, self.ipcon)
+            # Drawing calls are already sent without waiting for a response. Do the
+            # same for the GUI callback configuration so that none of the setup
+            # calls wait on a round trip to the bricklet.
+            self.lcd.set_response_expected(
+                BrickletLCD128x64.FUNCTION_SET_GUI_TAB_SELECTED_CALLBACK_CONFIGURATION,
+                False,
+            )
+            self.lcd.set_response_expected(
+                BrickletLCD128x64.FUNCTION_SET_GUI_BUTTON_PRESSED_CALLBACK_CONFIGURATION,
+                False,
+            )
             self.lcd.clear_display()
             self.lcd.remove_all_gui()
             LOGGER.info("LCD128x64 initialized")
         except TFConnectionError as error:
-            LOGGER.error("LCD128x64 init failed: " + str(error.description))
+            LOGGER.error("LCD128x64 init failed: %s", error.description)
             return
 
         self.lcd.set_gui_tab_selected_callback_configuration(GUI_READ_PERIOD, True)
@@ -134,13 +228,12 @@ class Heater:
     def cb_tab(self, index):
         self.active_tab = index
         self.lcd.clear_display()
+        self._reset_last_drawn()
         if index == 0:
             self.write_temp()
             self.write_power()
-            self.lcd.set_gui_button(0, 2, 22, 61, 14, "-1%")
-            self.lcd.set_gui_button(1, 66, 22, 61, 14, "+1%")
-            self.lcd.set_gui_button(2, 2, 38, 61, 14, "-10%")
-            self.lcd.set_gui_button(3, 66, 38, 61, 14, "+10%")
+            for button_index, layout in enumerate(POWER_BUTTON_LAYOUTS):
+                self.lcd.set_gui_button(button_index, *layout)
 
         elif index == 1:
             self.lcd.set_gui_graph_configuration(
@@ -155,36 +248,40 @@ class Heater:
             self.lcd.set_gui_button(4, 0, 10, 80, 20, "Shut Down")
 
     def _cb_power_button(self, power):
+        # Nothing to do when pressed while already clamped at 0 or 100
+        if power == self.heater_power:
+            return
         old_power = self.heater_power
         sticky_state_active = old_power == 100 or old_power == 0
         self.heater_power = power
+        self.pwm_on_time = power * PWM_PERIOD // 100
+        self.pwm_off_time = PWM_PERIOD - self.pwm_on_time
 
-        if power == 100:
-            self.relay.set_state(True)
-            self.heater_active = True
-        elif power == 0:
-            self.relay.set_state(False)
-            self.heater_active = False
-        elif 0 < power < 100 and sticky_state_active:
-            # If we're coming out of a sticky state, kick of the
-            # flop loop for PWM.
-            self.relay.set_state(False)
-            self.heater_active = False
-            self.relay.set_monoflop(False, 0)
+        with self._relay_lock:
+            # Once closed, the relay must stay off
+            if self.closed:
+                return
+            if power == 100:
+                self.relay.set_state(True)
+                self.heater_active = True
+            elif power == 0:
+                self.relay.set_state(False)
+                self.heater_active = False
+            elif 0 < power < 100 and sticky_state_active:
+                # If we're coming out of a sticky state, kick of the
+                # flop loop for PWM.
+                self.relay.set_state(False)
+                self.heater_active = False
+                self.relay.set_monoflop(False, 0)
 
         self.write_power()
 
     def cb_button(self, index, value):
         if value is False:
             return
-        if index == 0:
-            self._cb_power_button(max(self.heater_power - 1, 0))
-        elif index == 1:
-            self._cb_power_button(min(self.heater_power + 1, 100))
-        elif index == 2:
-            self._cb_power_button(max(self.heater_power - 10, 0))
-        elif index == 3:
-            self._cb_power_button(min(self.heater_power + 10, 100))
+        if index < len(POWER_BUTTON_DELTAS):
+            power = self.heater_power + POWER_BUTTON_DELTAS[index]
+            self._cb_power_button(max(min(power, 100), 0))
         elif index == 4:
             self.close()
             self.shutdown_host()
@@ -192,9 +289,15 @@ class Heater:
     def _init_thermocouple(self, uid):
         try:
             self.thermocouple = BrickletThermocoupleV2(uid, self.ipcon)
+            # As for the LCD, don't wait on a round trip for the callback
+            # configuration.
+            self.thermocouple.set_response_expected(
+                BrickletThermocoupleV2.FUNCTION_SET_TEMPERATURE_CALLBACK_CONFIGURATION,
+                False,
+            )
             LOGGER.info("Thermocouple initialized")
         except TFConnectionError as error:
-            LOGGER.error("Thermocouple init failed: " + str(error.description))
+            LOGGER.error("Thermocouple init failed: %s", error.description)
             return
 
         self.thermocouple.set_temperature_callback_configuration(
@@ -206,44 +309,56 @@ class Heater:
 
     def cb_thermocouple(self, value):
         celcius = int(value) / 100
-        self.temp_data.append(celcius)
-        self.write_temp()
-        self.update_graph()
+        self._append_temp(celcius)
+
+        if self.lcd is not None:
+            for update in self._tab_updaters[self.active_tab]:
+                update()
 
     def _init_relay(self, uid):
         try:
             self.relay = BrickletSolidStateRelayV2(uid, self.ipcon)
             LOGGER.info("Relay initialized")
         except TFConnectionError as error:
-            LOGGER.error("Relay init failed: " + str(error.description))
+            LOGGER.error("Relay init failed: %s", error.description)
             return
 
+        # Bound once as this is called on every PWM edge
+        self._set_monoflop = self.relay.set_monoflop
         self.relay.register_callback(
             BrickletSolidStateRelayV2.CALLBACK_MONOFLOP_DONE, self.cb_relay_flop
         )
         self.relay.set_state(False)
 
     def cb_relay_flop(self, _):
-        on_time = round((self.heater_power / 100) * PWM_PERIOD)
-        off_time = PWM_PERIOD - on_time
-
-        if self.heater_power < 100:
-            if self.heater_active:
-                self.relay.set_monoflop(False, off_time)
-                self.heater_active = False
-            else:
-                self.relay.set_monoflop(True, on_time)
-                self.heater_active = True
-        # If power is 0 or 100, we're not using the flop loop
+        with self._relay_lock:
+            if self.closed:
+                return
+            if 0 < self.heater_power < 100:
+                if self.heater_active:
+                    self._set_monoflop(False, self.pwm_off_time)
+                    self.heater_active = False
+                else:
+                    self._set_monoflop(True, self.pwm_on_time)
+                    self.heater_active = True
+            # If power is 0 or 100, we're not using the flop loop
+
+    def _reset_last_drawn(self):
+        self._last_temp_string = None
+        self._last_power_string = None
+        self._last_axis_strings = None
+        self._last_graph_data = None
 
     def write_temp(self):
         if self.lcd is None:
             return
-        if self.active_tab != 0:
-            return
-        current_temp = self.temp_data[-1]
+        current_temp = self._latest_temp()
         temp_string = f"Temp: {current_temp:6.2f}\xDFC"
-        self.lcd.draw_box(0, 0, 127, 10, True, BrickletLCD128x64.COLOR_WHITE)
+        if temp_string == self._last_temp_string:
+            return
+        if self._last_temp_string is not None:
+            self.lcd.draw_box(0, 0, 127, 10, True, BrickletLCD128x64.COLOR_WHITE)
+        self._last_temp_string = temp_string
         self.lcd.draw_text(0, 0, BrickletLCD128x64.FONT_6X8, True, temp_string)
 
     def write_power(self):
@@ -251,29 +366,32 @@ class Heater:
             return
         if self.active_tab != 0:
             return
-        self.lcd.draw_box(0, 11, 127, 20, True, BrickletLCD128x64.COLOR_WHITE)
         string = f"Power: {self.heater_power}%"
+        if string == self._last_power_string:
+            return
+        if self._last_power_string is not None:
+            self.lcd.draw_box(0, 11, 127, 20, True, BrickletLCD128x64.COLOR_WHITE)
+        self._last_power_string = string
         self.lcd.draw_text(0, 11, BrickletLCD128x64.FONT_6X8, True, string)
 
     def update_axis(self):
-        self.lcd.draw_box(0, 0, 20, 10, True, BrickletLCD128x64.COLOR_WHITE)
-        self.lcd.draw_box(0, 45, 20, 55, True, BrickletLCD128x64.COLOR_WHITE)
-        self.lcd.draw_text(
-            0, 0, BrickletLCD128x64.FONT_6X8, True, f"{self.axis_max:3.0f}"
-        )
-        self.lcd.draw_text(
-            0, 45, BrickletLCD128x64.FONT_6X8, True, f"{self.axis_min:3.0f}"
-        )
-        self.lcd.draw_text(0, 107, BrickletLCD128x64.FONT_6X8, True, f"")
+        max_string = f"{self.axis_max:3.0f}"
+        min_string = f"{self.axis_min:3.0f}"
+        if (max_string, min_string) == self._last_axis_strings:
+            return
+        if self._last_axis_strings is not None:
+            self.lcd.draw_box(0, 0, 20, 10, True, BrickletLCD128x64.COLOR_WHITE)
+            self.lcd.draw_box(0, 45, 20, 55, True, BrickletLCD128x64.COLOR_WHITE)
+        self._last_axis_strings = (max_string, min_string)
+        self.lcd.draw_text(0, 0, BrickletLCD128x64.FONT_6X8, True, max_string)
+        self.lcd.draw_text(0, 45, BrickletLCD128x64.FONT_6X8, True, min_string)
 
     def update_graph(self):
         if self.lcd is None:
             return
-        if self.active_tab != 1:
-            return
 
-        max_temp = round(max(self.temp_data))
-        min_temp = round(min(self.temp_data))
+        max_temp = round(self._max_temps[0][1])
+        min_temp = round(self._min_temps[0][1])
 
         # Pad a little bit for looks
         max_temp *= 1.1
@@ -284,63 +402,70 @@ class Heater:
             # This probably means we don't have any data yet
             return
 
-        scaled_data = [((value - min_temp) / diff) * 255 for value in self.temp_data]
-
-        # This gets rid of any randomness which apparently sometimes occurs when
-        # the thermocouple bricklet is physically bumped.
-        scaled_data = map(lambda value: max(min(value, 255), 0), scaled_data)
+        # Scale and clamp in a single pass. The clamp gets rid of any randomness
+        # which apparently sometimes occurs when the thermocouple bricklet is
+        # physically bumped.
+        scale = 255 / diff
+        graph_data = self._graph_data
+        for i, value in enumerate(self._temps_oldest_first()):
+            scaled = int((value - min_temp) * scale)
+            graph_data[i] = 0 if scaled < 0 else 255 if scaled > 255 else scaled
 
         if max_temp != self.axis_max or min_temp != self.axis_min:
             self.axis_max = max_temp
             self.axis_min = min_temp
             self.update_axis()
 
-        self.lcd.set_gui_graph_data(0, scaled_data)
+        # Steady readings often scale to exactly the same graph
+        if graph_data == self._last_graph_data:
+            return
+        self._last_graph_data = bytes(graph_data)
+        self.lcd.set_gui_graph_data(0, graph_data)
 
     def cb_enumerate(self, uid, _, __, ___, ____, device_identifier, enumeration_type):
         if (
             enumeration_type == IPConnection.ENUMERATION_TYPE_CONNECTED
             or enumeration_type == IPConnection.ENUMERATION_TYPE_AVAILABLE
         ):
-            if device_identifier == BrickletLCD128x64.DEVICE_IDENTIFIER:
-                self._init_lcd(uid)
-            elif device_identifier == BrickletThermocoupleV2.DEVICE_IDENTIFIER:
-                self._init_thermocouple(uid)
-            elif device_identifier == BrickletSolidStateRelayV2.DEVICE_IDENTIFIER:
-                self._init_relay(uid)
+            init_device = self._device_initialisers.get(device_identifier)
+            if init_device is not None:
+                init_device(uid)
 
     def cb_connected(self, connected_reason):
         if connected_reason == IPConnection.CONNECT_REASON_AUTO_RECONNECT:
             LOGGER.info("Auto Reconnect")
-
-            while True:
-                try:
-                    self.ipcon.enumerate()
-                    break
-                except TFConnectionError as error:
-                    LOGGER.error("Enumerate Error: " + str(error.description))
-                    sleep(1)
+            self._enumerate()
 
     def close(self):
+        # close() can run on the main thread while callbacks are still being
+        # delivered, so switch the relay off under the lock to stop a callback
+        # turning it back on before we disconnect.
+        with self._relay_lock:
+            if self.closed:
+                return
+            self.closed = True
+            if self.relay:
+                self.relay.set_state(False)
+
         if self.lcd:
             self.lcd.clear_display()
             self.lcd.remove_all_gui()
-        if self.relay:
-            self.relay.set_state(False)
         if self.ipcon is not None:
             self.ipcon.disconnect()
         LOGGER.info("Heater shut down")
 
     def shutdown_host(self):
-        run("sudo shutdown now", shell=True)
+        run(["sudo", "shutdown", "now"])
 
 
 if __name__ == "__main__":
     heater = Heater()
     atexit.register(heater.close)
 
-    loop = asyncio.get_event_loop()
-    try:
-        loop.run_forever()
-    finally:
-        loop.close()
+    # All the work happens in Tinkerforge callbacks, so the main thread just
+    # sleeps until we're asked to stop. Exiting normally ensures the atexit
+    # cleanup runs.
+    stop = Event()
+    for signal_number in (SIGINT, SIGTERM):
+        signal(signal_number, lambda *_: stop.set())
+    stop.wait()